@@ -14,6 +14,7 @@ import shutil
 import subprocess
 import copy
 import sqlite3
+import json
 import string
 from pyxdameraulevenshtein import damerau_levenshtein_distance_seqs, normalized_damerau_levenshtein_distance_seqs
 import numpy as np
@@ -35,6 +36,8 @@ parser.add_argument('--debug', action='store_true', help="Enable debug output.")
 parser.add_argument('--cron', action='store_true', help="Disable all console output.")
 parser.add_argument('--properclean', action='store_true',
                     help="Performs a proper/repack clean on the entire destinationfolder.")
+parser.add_argument('--dedup', action='store_true',
+                    help="Removes lower quality duplicate episodes from the entire destination folder.")
 
 args = parser.parse_args()
 
@@ -97,6 +100,90 @@ if 'overrides' in config_data.keys():
 else:
     overrides = {}
 
+if 'orphans' in config_data.keys() and config_data['orphans'] is not None:
+    orphan_config = config_data['orphans']
+else:
+    orphan_config = None
+
+if 'dedup' in config_data.keys() and config_data['dedup'] is not None:
+    dedup_config = config_data['dedup']
+else:
+    dedup_config = {}
+
+if 'space' in config_data.keys() and config_data['space'] is not None:
+    space_config = config_data['space']
+else:
+    space_config = {}
+
+if 'io' in config_data.keys() and config_data['io'] is not None:
+    io_config = config_data['io']
+else:
+    io_config = {}
+
+def parse_size(value):
+    """
+    Convert a size such as 500K, 20M or 1.5G into bytes.
+    """
+    match = re.match(r'^\s*([\d\.]+)\s*([KMGT]?)i?B?\s*$', str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError('Invalid size: {0}'.format(value))
+    return int(float(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2).upper() or ' '))
+
+def format_size(size):
+    """
+    Convert a number of bytes into a readable size such as 1.5G.
+    """
+    for unit in ['', 'K', 'M', 'G']:
+        if abs(size) < 1024:
+            return '{0:.1f}{1}'.format(size, unit)
+        size /= 1024.0
+    return '{0:.1f}T'.format(size)
+
+def set_io_priority():
+    """
+    Lower the cpu and disk priority of this process, child processes such as unrar inherit the priority.
+    """
+    if 'nice' in io_config:
+        try:
+            os.nice(int(io_config['nice']))
+        except:
+            logging.exception('Failed to set nice level {0}'.format(io_config['nice']))
+    if 'ionice_class' in io_config:
+        command = ['ionice', '-c', str(io_config['ionice_class'])]
+        if 'ionice_level' in io_config:
+            command += ['-n', str(io_config['ionice_level'])]
+        command += ['-p', str(os.getpid())]
+        try:
+            p = subprocess.Popen(command, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.STDOUT)
+            ioniceoutput = p.communicate()[0]
+            if p.returncode != 0:
+                logging.error("Failed to set io priority, command: {0} \nOutput:\n{1}".format(' '.join(command), ioniceoutput))
+        except:
+            logging.exception('Failed to set io priority')
+
+set_io_priority()
+
+# Bandwidth limits in bytes per second, keyed by device of the configured path.
+device_bandwidth = {}
+if 'bandwidth' in io_config and io_config['bandwidth'] is not None:
+    for path, limit in io_config['bandwidth'].items():
+        try:
+            device_bandwidth[os.stat(path).st_dev] = parse_size(limit)
+        except:
+            logging.exception('Invalid bandwidth limit {0} for {1}'.format(limit, path))
+# Time at which each throttled device is next free for more I/O.
+device_next_io = {}
+io_chunk_size = 1024 * 1024
+recent_seconds = float(io_config.get('recent_hours', 24)) * 3600
+
+# Free space kept in reserve on every target volume.
+space_reserve = parse_size(space_config.get('reserve', '1G'))
+# Per device bookkeeping for the run summary, bytes admitted and deferred and the last free space seen.
+space_planned = {}
+space_deferred = {}
+space_available = {}
+space_paths = {}
+
 # Open or initialize database.
 database_file = os.path.join(os.getenv("HOME"), '.organize', 'copied.db')
 db = sqlite3.connect(database_file)
@@ -106,6 +193,12 @@ cursor = db.cursor()
 cursor.execute('''
     create table if not exists copied (file TEXT)
 ''')
+cursor.execute('''
+    create table if not exists parsed (file TEXT PRIMARY KEY, size INTEGER, mtime REAL, info TEXT)
+''')
+cursor.execute('''
+    create table if not exists extracted (file TEXT PRIMARY KEY, torrent TEXT)
+''')
 db.commit()
 
 def db_add_copied(file):
@@ -123,6 +216,57 @@ def db_get_copied():
     cursor.execute('SELECT file FROM copied')
     return [file[0] for file in cursor]
 
+# Parse results worth keeping, the rest of the guessit output is not used.
+parsed_keys = ['title', 'season', 'episode', 'screen_size', 'source', 'proper_count', 'other']
+
+def db_get_parsed(file):
+    """
+    Return the guessit results for a file, reusing the stored results while the file is unchanged.
+    """
+    stat = os.stat(file)
+    cursor = db.cursor()
+    cursor.execute('SELECT info FROM parsed WHERE file = ? AND size = ? AND mtime = ?', (file, stat.st_size, stat.st_mtime))
+    row = cursor.fetchone()
+    if row is not None:
+        return json.loads(row[0])
+    video_info = guessit(file)
+    info = dict((key, video_info[key]) for key in parsed_keys if key in video_info.keys())
+    info = json.loads(json.dumps(info, default=str))
+    cursor.execute('INSERT OR REPLACE INTO parsed(file, size, mtime, info) VALUES (?, ?, ?, ?)', (file, stat.st_size, stat.st_mtime, json.dumps(info)))
+    db.commit()
+    return info
+
+def db_rem_parsed(file):
+    cursor = db.cursor()
+    cursor.execute('DELETE FROM parsed WHERE file = ?', (file,))
+    db.commit()
+
+def db_prune_parsed():
+    """
+    Remove stored parse results for files that no longer exist.
+    """
+    cursor = db.cursor()
+    cursor.execute('SELECT file FROM parsed')
+    missing = [(file[0],) for file in cursor.fetchall() if not os.path.exists(file[0])]
+    cursor.executemany('DELETE FROM parsed WHERE file = ?', missing)
+    db.commit()
+    logging.debug('Pruned {0} stored parse results for missing files.'.format(len(missing)))
+
+def db_add_extracted(file, torrent):
+    cursor = db.cursor()
+    cursor.execute('INSERT OR REPLACE INTO extracted(file, torrent) VALUES (?, ?)', (file, torrent))
+    db.commit()
+
+def db_rem_extracted(file):
+    cursor = db.cursor()
+    cursor.execute('DELETE FROM extracted WHERE file = ?', (file,))
+    db.commit()
+
+def db_get_extracted():
+    cursor = db.cursor()
+    cursor.execute('SELECT file, torrent FROM extracted')
+    return dict((file, torrent) for file, torrent in cursor)
+
 def move_event(file, description):
     logging.debug('Checking for move event.')
     if 'events' in config_data.keys() and config_data['events'] is not None and 'moved' in config_data['events'] and config_data['events']['moved']:
@@ -135,7 +279,197 @@ def move_event(file, description):
                 logging.error("Move event returned error {0}:\n{1}".format( eventoutput))
         except:
             logging.exception('Failed to execute move event {0}'.format(config_data['events']['move']))
-        
+
+def remove_partial(file):
+    """
+    Remove a partially written file after a failed copy or extraction so the next run starts clean.
+    """
+    try:
+        if os.path.isfile(file):
+            os.remove(file)
+            logging.info('Removed partial file: {0}'.format(file))
+    except:
+        logging.exception('Failed to remove partial file: {0}'.format(file))
+
+def existing_parent(path):
+    """
+    Return path or its closest parent that exists, used to find the volume of a directory not created yet.
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+def space_admit(target_dir, size, description):
+    """
+    Check that size bytes fit on the volume of target_dir while keeping the configured reserve free, work of size 0
+    is always admitted. Returns False and records the work as deferred if it does not fit.
+    """
+    path = existing_parent(target_dir)
+    device = os.stat(path).st_dev
+    space_paths.setdefault(device, path)
+    stat = os.statvfs(path)
+    available = stat.f_bavail * stat.f_frsize
+    space_available[device] = available
+    # Nothing is written in a dryrun, so account for the work planned so far on this volume.
+    if args.dryrun:
+        available -= space_planned.get(device, 0)
+    # Work that takes no space, such as a rename within the volume, always fits.
+    if size > 0 and size + space_reserve > available:
+        logging.warning('Deferring {0}, needs {1} but {2} is available on {3} with {4} reserved.'.format(
+            description, format_size(size), format_size(max(available, 0)), path, format_size(space_reserve)))
+        space_deferred[device] = space_deferred.get(device, 0) + size
+        return False
+    space_planned[device] = space_planned.get(device, 0) + size
+    return True
+
+def space_needed(source, target_dir, copy):
+    """
+    Bytes a copy or move of source into target_dir will take up, a move within a volume is only a rename.
+    """
+    target = os.path.join(target_dir, os.path.basename(source))
+    if not copy and os.stat(source).st_dev == os.stat(existing_parent(target_dir)).st_dev:
+        return 0
+    size = os.path.getsize(source)
+    # The file being replaced frees its space.
+    if os.path.isfile(target):
+        size -= os.path.getsize(target)
+    return max(size, 0)
+
+def rar_contents(rarfile):
+    """
+    Return a dictionary of file name to unpacked size for a rar archive, including all of its volumes.
+    """
+    contents = {}
+    command = ['unrar', 'lt', rarfile]
+    try:
+        p = subprocess.Popen(command, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.STDOUT)
+        raroutput = p.communicate()[0].decode('utf-8', 'replace')
+        name = None
+        for line in raroutput.splitlines():
+            match = re.match(r'^\s*Name:\s*(.*)$', line)
+            if match:
+                name = match.group(1)
+            match = re.match(r'^\s*Size:\s*(\d+)', line)
+            if match and name is not None:
+                # Files split across volumes are listed once per volume with the same size.
+                contents[name] = int(match.group(1))
+                name = None
+        if p.returncode != 0:
+            logging.debug("Failed to list rar file, command: {0} \nOutput:\n{1}".format(' '.join(command), raroutput))
+    except:
+        logging.exception('Failed to list rar file {0}'.format(rarfile))
+    return contents
+
+def rar_unpacked_size(rarfile, contents):
+    """
+    Unpacked size of a rar archive, estimated from the size of its volumes when it can't be listed.
+    """
+    if len(contents) > 0:
+        return sum(contents.values())
+    prefix = re.sub(r'(\.part\d+)?\.rar$', '', os.path.basename(rarfile), flags=re.IGNORECASE)
+    directory = os.path.dirname(rarfile)
+    return sum(os.path.getsize(os.path.join(directory, item)) for item in os.listdir(directory)
+               if item.startswith(prefix) and re.match(r'.*\.(rar|r\d\d)$', item, re.IGNORECASE))
+
+def io_throttle(devices, size):
+    """
+    Sleep as needed to keep each device under its configured bandwidth limit after transferring size bytes.
+    """
+    now = time.time()
+    wait = 0
+    for device in devices:
+        if device not in device_bandwidth:
+            continue
+        start = max(device_next_io.get(device, now), now)
+        device_next_io[device] = start + size / device_bandwidth[device]
+        wait = max(wait, device_next_io[device] - now)
+    if wait > 0:
+        time.sleep(wait)
+
+def io_copy(source, target_dir):
+    """
+    Copy a file into target_dir like shutil.copy, limited to the bandwidth configured for the source and target devices.
+    """
+    target = os.path.join(target_dir, os.path.basename(source))
+    devices = {os.stat(source).st_dev, os.stat(target_dir).st_dev}
+    throttled = len(devices.intersection(device_bandwidth)) > 0
+    with open(source, 'rb') as fsrc:
+        # Only a target this call has truncated is removed on failure, an existing file is left alone otherwise.
+        written = False
+        try:
+            with open(target, 'wb') as fdst:
+                written = True
+                if not throttled:
+                    shutil.copyfileobj(fsrc, fdst, io_chunk_size)
+                else:
+                    while True:
+                        buf = fsrc.read(io_chunk_size)
+                        if not buf:
+                            break
+                        fdst.write(buf)
+                        io_throttle(devices, len(buf))
+            shutil.copymode(source, target)
+        except:
+            if written:
+                remove_partial(target)
+            raise
+    return target
+
+def io_move(source, target_dir):
+    """
+    Move a file or directory into target_dir like shutil.move, a move across devices is a throttled copy followed by a delete.
+    """
+    target = os.path.join(target_dir, os.path.basename(source))
+    if os.stat(source).st_dev == os.stat(target_dir).st_dev:
+        shutil.move(source, target_dir)
+    elif os.path.isdir(source) and not os.path.islink(source):
+        for root, dirs, files in os.walk(source):
+            root_target = os.path.join(target, os.path.relpath(root, source))
+            if not os.path.exists(root_target):
+                os.makedirs(root_target)
+            for file in files:
+                io_copy(os.path.join(root, file), root_target)
+                shutil.copystat(os.path.join(root, file), os.path.join(root_target, file))
+        shutil.rmtree(source)
+    else:
+        io_copy(source, target_dir)
+        shutil.copystat(source, target)
+        os.remove(source)
+    return target
+
+def path_stats(path):
+    """
+    Return the total size in bytes and the newest modification time of a file or directory tree.
+    """
+    stat = os.lstat(path)
+    size = stat.st_size
+    newest = max(stat.st_mtime, stat.st_ctime)
+    if os.path.isdir(path) and not os.path.islink(path):
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                stat = os.lstat(os.path.join(root, name))
+                if name in files:
+                    size += stat.st_size
+                newest = max(newest, stat.st_mtime, stat.st_ctime)
+    return size, newest
+
+def io_queue_key(path):
+    """
+    Sort key for queued work, recently finished downloads go first and then smaller files before larger ones.
+    Torrents use the finish time and size reported by transmission, anything else the size and newest time on disk.
+    """
+    if path in torrent_done:
+        done, size = torrent_done[path]
+    else:
+        try:
+            # ctime catches freshly extracted files, unrar restores the older mtime from the archive.
+            size, done = path_stats(path)
+        except OSError:
+            return (1, 0)
+    recent = done > 0 and time.time() - done < recent_seconds
+    return (0 if recent else 1, size)
+
 client = None
 retry_count = 0
 while (client is None and retry_count < 5):
@@ -154,12 +488,15 @@ if client is None:
 logging.debug('Creating cache of files from transmission.')
 torrent_files = []
 torrent_dirs = []
+# Finish time and total size of each torrent, keyed by its path, used to order the work queue.
+torrent_done = {}
 try:
-    for torrent in client.get_torrents(arguments=['downloadDir', 'id', 'name']):
+    for torrent in client.get_torrents(arguments=['downloadDir', 'id', 'name', 'doneDate', 'totalSize']):
         directory = torrent.downloadDir
         dirwithname = os.path.join(directory, torrent.name)
         #logging.debug('Adding seeding directory: {0}'.format(dirwithname))
         torrent_dirs.append(dirwithname)
+        torrent_done[dirwithname] = (torrent.doneDate, torrent.totalSize)
         for id, info in iter(client.get_files(ids=[torrent.id])[torrent.id].items()):
             #logging.debug(os.path.join(directory,info['name']).encode('ascii', 'replace'))
             torrent_files.append(os.path.join(directory,info['name']))
@@ -181,6 +518,14 @@ def find_files(directory, include, exclude=None):
                 if exclude is None or not re.match(exclude, file, re.IGNORECASE):
                     yield os.path.join(root, file)
 
+def find_rar_files(directory):
+    """
+    Find the first volume of each rar set in a torrent directory, skipping subtitles and samples.
+    """
+    rar_files = list(find_files(directory, '.*\.rar$', '.*part(\d*[2-9]).rar$'))
+    rar_files = [file for file in rar_files if (not re.search('\.subs\.', file, re.IGNORECASE))]
+    return [file for file in rar_files if (not re.search('\.sample\.', file, re.IGNORECASE))]
+
 def proper_cleanup(file):
     """
     Check if this file is a proper, and if so check if there's any matching files in the same folder that should be cleaned up.
@@ -195,7 +540,7 @@ def proper_cleanup(file):
         return
     
     directory = os.path.dirname(file)
-    video_info = guessit(file)
+    video_info = db_get_parsed(file)
     if not 'title' in video_info.keys() or not 'episode' in video_info.keys():
         logging.debug('Series and episode number undetermined, skipping proper/repack cleanup for {0}'.format(file))
         return
@@ -203,7 +548,7 @@ def proper_cleanup(file):
     for item in os.listdir(directory):
         matchfile = os.path.join(directory, item)
         if matchfile != file and os.path.isfile(matchfile) and re.match(video_file_regex, matchfile, re.IGNORECASE):
-            video_info2 = guessit(matchfile)
+            video_info2 = db_get_parsed(matchfile)
             if (not 'season' in video_info.keys() or ('season' in video_info2.keys() and video_info['season'] == video_info2['season'])) and \
                (not 'screen_size' in video_info.keys() or ('screen_size' in video_info2.keys() and video_info['screen_size'] == video_info2['screen_size'])) and \
                'title' in video_info2.keys() and video_info['title'] == video_info2['title'] and \
@@ -219,31 +564,154 @@ def proper_cleanup(file):
             else:
                 try:
                     os.remove(file)
+                    db_rem_parsed(file)
                     logging.info('Deleted: {0}'.format(file))
                 except:
                     logging.exception('Failed to delete {0}'.format(file))
     
+# Sources from best to worst, names as reported by guessit.
+default_sources = ['Ultra HD Blu-ray', 'Blu-ray', 'HD-DVD', 'Web', 'HDTV', 'DVD', 'Satellite', 'Digital TV', 'TV', 'VHS', 'Telecine', 'Telesync', 'Camera']
+
+def quality_key(file, video_info):
+    """
+    Values ranking a copy of an episode by the configured quality ranking, higher is better. A resolution or source
+    that isn't tagged is None, unknown rather than worst, see known_quality_keys. The modification time is last so ties go to the newest file,
+    matching the proper/repack cleanup.
+    """
+    key = []
+    for rank in dedup_config.get('ranking', ['resolution', 'source', 'proper', 'size']):
+        if rank == 'resolution':
+            match = re.match(r'(\d+)', str(video_info.get('screen_size', '')))
+            if str(video_info.get('screen_size', '')).upper() == '4K':
+                key.append(2160)
+            else:
+                key.append(int(match.group(1)) if match else None)
+        elif rank == 'source':
+            sources = dedup_config.get('sources', default_sources)
+            source = video_info.get('source')
+            if source is None:
+                key.append(None)
+            else:
+                key.append(len(sources) - sources.index(source) if source in sources else 0)
+        elif rank == 'proper':
+            if 'proper_count' in video_info:
+                key.append(video_info['proper_count'])
+            else:
+                key.append(1 if re.match(r'.*\.(proper|repack)\.', file, re.IGNORECASE) else 0)
+        elif rank == 'size':
+            key.append(os.path.getsize(file))
+        else:
+            logging.warning('Unknown dedup ranking: {0}'.format(rank))
+    key.append(os.path.getmtime(file))
+    return key
+
+def known_quality_keys(keys):
+    """
+    Drop any criterion that is unknown for one of the quality_key results of a group, so the whole group is ranked
+    on the same criteria and the next known one decides.
+    """
+    known = [i for i in range(len(keys[0])) if all(key[i] is not None for key in keys)]
+    return [tuple(key[i] for i in known) for key in keys]
+
+def dedup_directory(directory):
+    """
+    Delete all but the best copy of each episode in a series or season folder. Files are grouped by series, season
+    and episode, as one folder can hold more than one series. Returns the number of bytes deleted, or that would be
+    in a dryrun.
+    """
+    logging.debug('Checking {0} for duplicate episodes.'.format(directory))
+    groups = {}
+    for item in sorted(os.listdir(directory)):
+        file = os.path.join(directory, item)
+        if not os.path.isfile(file) or not re.match(video_file_regex, file, re.IGNORECASE):
+            continue
+        try:
+            video_info = db_get_parsed(file)
+        except:
+            logging.exception('Failed to parse {0}'.format(file))
+            continue
+        if not 'title' in video_info.keys() or not 'episode' in video_info.keys():
+            continue
+        episode = video_info['episode']
+        if isinstance(episode, list):
+            episode = tuple(episode)
+        group = (compare_strip(video_info['title']), video_info.get('season'), episode)
+        groups.setdefault(group, []).append((file, video_info))
+
+    reclaimed = 0
+    for matches in groups.values():
+        if len(matches) < 2:
+            continue
+        keys = known_quality_keys([quality_key(file, video_info) for file, video_info in matches])
+        keys = dict((match[0], key) for match, key in zip(matches, keys))
+        matches.sort(key=lambda x: keys[x[0]], reverse=True)
+        logging.info('Keeping best copy of duplicate episode: {0}'.format(matches[0][0]))
+        for file, video_info in matches[1:]:
+            size = os.path.getsize(file)
+            if args.dryrun:
+                logging.info('Would delete lower quality duplicate ({0}): {1}'.format(format_size(size), file))
+                reclaimed += size
+            else:
+                try:
+                    os.remove(file)
+                    db_rem_parsed(file)
+                    logging.info('Deleted lower quality duplicate ({0}): {1}'.format(format_size(size), file))
+                    reclaimed += size
+                except:
+                    logging.exception('Failed to delete {0}'.format(file))
+    return reclaimed
+
+def replaced_cleanup(file):
+    """
+    Clean up files replaced by a newly organized file, using the dedup ranking when enabled.
+    """
+    if dedup_config.get('auto', False):
+        dedup_directory(os.path.dirname(file))
+    else:
+        proper_cleanup(file)
+
 video_files = []
    
 
 # Iterate through the seeding directory, we should expect each of these to be a torrent, either a single file or a directory.
-for item in sorted(os.listdir(config_data['directories']['seeding'])):
+# Recently finished torrents are handled first so new episodes aren't stuck behind a backlog.
+seeding_items = sorted(os.listdir(config_data['directories']['seeding']))
+seeding_items.sort(key=lambda x: io_queue_key(os.path.join(config_data['directories']['seeding'], x)))
+for item in seeding_items:
     path = os.path.join(config_data['directories']['seeding'], item)
     if os.path.isdir(path):
         # It's a directory, we need to check out what it contains.
         #logging.info('Searching for rar files in {0}'.format(path))
-        rar_files = list(find_files(path, '.*\.rar$', '.*part(\d*[2-9]).rar$'))
-        rar_files = [file for file in rar_files if (not re.search('\.subs\.', file, re.IGNORECASE)) and not os.path.exists(path + "/.autoextracted")]
-        #rar_files = [file for file in rar_files if (not re.search('\.subs\.', file, re.IGNORECASE))]
-        rar_files = [file for file in rar_files if (not re.search('\.sample\.', file, re.IGNORECASE))]
+        if os.path.exists(path + "/.autoextracted"):
+            rar_files = []
+        else:
+            rar_files = find_rar_files(path)
+        # Rar sets already extracted from a directory that was only partly extracted by an earlier run.
+        partial_marker = os.path.join(path, '.autoextracted.partial')
+        if os.path.exists(partial_marker):
+            with open(partial_marker) as f:
+                extracted_rars = set(line.rstrip('\n') for line in f)
+        else:
+            extracted_rars = set()
         
         video_files += list(find_files(path, video_file_regex))
         
         #print("{0} : {1} rar files, {2} video files".format(item, len(rar_files), len(video_files)))
+        # Only mark the directory as extracted once every rar set in it has been, deferred or failed sets are retried.
+        all_extracted = True
         for rarfile in rar_files:
+            if rarfile in extracted_rars:
+                continue
+            contents = rar_contents(rarfile)
+            if not space_admit(config_data['directories']['extracted'], rar_unpacked_size(rarfile, contents), rarfile):
+                all_extracted = False
+                continue
             if args.dryrun:
                 logging.info("Would extract rar file: {0}".format(rarfile))
             else:
+                # Files extracted by this run, removed again if the extraction fails part way.
+                new_files = [os.path.join(config_data['directories']['extracted'], name) for name in contents
+                             if not os.path.exists(os.path.join(config_data['directories']['extracted'], name))]
                 try:
                     logging.info("Extracting rar file: {0}".format(rarfile))
                     command = ['unrar', 'x', '-o-', '-y', '-idq', rarfile, config_data['directories']['extracted']]
@@ -251,11 +719,25 @@ for item in sorted(os.listdir(config_data['directories']['seeding'])):
                     raroutput = p.communicate()[0]
                     if p.returncode != 0:
                         logging.error("Failed to extract, command: {0} \nOutput:\n{1}".format(' '.join(command), raroutput))
+                        all_extracted = False
+                        for new_file in new_files:
+                            remove_partial(new_file)
                     else:
                         logging.info("Extracted rar file: {0}".format(rarfile))
-                        open(os.path.join(path,'.autoextracted'), 'w').close()
+                        with open(partial_marker, 'a') as f:
+                            f.write(rarfile + '\n')
+                        # Remember which torrent extracted content came from for the orphan sweep.
+                        for name in set(name.split(os.sep)[0] for name in contents):
+                            db_add_extracted(os.path.join(config_data['directories']['extracted'], name), path)
                 except:
                     logging.exception('Failed to extract {0}'.format(rarfile))
+                    all_extracted = False
+                    for new_file in new_files:
+                        remove_partial(new_file)
+        if len(rar_files) > 0 and all_extracted and not args.dryrun:
+            open(os.path.join(path,'.autoextracted'), 'w').close()
+            if os.path.exists(partial_marker):
+                os.remove(partial_marker)
     elif re.match(video_file_regex, item, re.IGNORECASE):
         video_files.append(item)
     else:
@@ -267,6 +749,9 @@ video_files = [file for file in video_files if \
     not re.search('/sample/', file, re.IGNORECASE) \
     and not re.search('[\.\-]sample\.', file, re.IGNORECASE)
     ]
+video_files.sort(key=lambda x: io_queue_key(os.path.join(config_data['directories']['seeding'], x)))
+# Video files not organized yet, removed from as they are handled so the orphan sweep leaves the rest alone.
+pending_files = set(os.path.join(config_data['directories']['seeding'], file) for file in video_files)
 
 
 def compare_strip(s):
@@ -344,6 +829,9 @@ for file in video_files:
         if is_seeding(source_file):
             if source_file in db_get_copied():
                 logging.debug('Ignoring file {0}, it has already been copied.'.format(source_file))
+                pending_files.discard(source_file)
+            elif not space_admit(target_dir, space_needed(source_file, target_dir, True), source_file):
+                continue
             elif args.dryrun:
                 logging.info('Would copy and schedule original for delete {0} to {1}'.format(source_file, target_dir))
             else:
@@ -351,11 +839,15 @@ for file in video_files:
                 logging.info('Copying and schedule original for delete: {0} to {1}'.format(source_file, target_dir))
                 try:
                     db_add_copied(source_file)
-                    shutil.copy(source_file, target_dir)
-                    move_event(target_file, description)
-                    proper_cleanup(target_file)
+                    io_copy(source_file, target_dir)
                 except:
                     logging.exception('Failed to copy file.')
+                    # Forget the copy so it is attempted again on the next run.
+                    db_rem_copied(source_file)
+                else:
+                    pending_files.discard(source_file)
+                    move_event(target_file, description)
+                    replaced_cleanup(target_file)
         elif source_file in db_get_copied():
             if args.dryrun:
                 logging.info('Would delete already copied file {0}'.format(source_file))
@@ -363,8 +855,11 @@ for file in video_files:
                 logging.info('Deleting already moved file {0}'.format(source_file))
                 try:
                     os.remove(source_file)
+                    pending_files.discard(source_file)
                 except:
                     logging.exception('Failed to delete file.')
+        elif not space_admit(target_dir, space_needed(source_file, target_dir, False), source_file):
+            continue
         else:
             if args.dryrun:
                 logging.info('Would move {0} to {1}'.format(source_file, target_dir))
@@ -374,9 +869,10 @@ for file in video_files:
                     # Delete any pre-existing files in the way. Default is to replace, check happens earlier to make sure we're not replacing with an incomplete file.
                     if os.path.exists(target_file):
                         os.remove(target_file)
-                    shutil.move(source_file, target_dir)
+                    io_move(source_file, target_dir)
+                    pending_files.discard(source_file)
                     move_event(target_file, description)
-                    proper_cleanup(target_file)
+                    replaced_cleanup(target_file)
                 except IOError as e:
                     if e.errno == 13:
                         logging.warn('Invalid permissions to move file.')
@@ -460,12 +956,165 @@ for file in db_get_copied():
             except:
                 logging.exception('Failed to delete previously copied file: {0}'.format(file))
 
-# TODO: Clean up files for torrents that were possible manually removed from transmission.
+def holds_pending(path):
+    """
+    Check if a file or directory still holds work the organizer has not finished, video files that were not
+    organized or rar files that were never extracted.
+    """
+    if not os.path.isdir(path):
+        return path in pending_files
+    if any(file in pending_files for file in find_files(path, video_file_regex)):
+        return True
+    return not os.path.exists(os.path.join(path, '.autoextracted')) and len(find_rar_files(path)) > 0
+
+def owned_by_torrent(path, torrent_paths):
+    """
+    Check if a path holds data of a torrent, either a torrent itself, an incomplete file renamed to .part by
+    transmission, or a directory some torrent downloads into.
+    """
+    if path in torrent_paths or re.sub(r'\.part$', '', path) in torrent_paths:
+        return True
+    return any(torrent_path.startswith(path + os.sep) for torrent_path in torrent_paths)
+
+def find_orphans():
+    """
+    Find items in the seeding and extracted directories that no torrent or pending copy accounts for.
+    Returns a list of (path, directory name, size) tuples.
+    """
+    # Refresh the torrent list, torrents may have been added or removed since the cache was built.
+    seeding_dirs = set(os.path.join(torrent.downloadDir, torrent.name) for torrent in client.get_torrents(arguments=['downloadDir', 'name']))
+    seeding_dirs.update(torrent_dirs)
+    copied = db_get_copied()
+    extracted = db_get_extracted()
+    for file in extracted:
+        if not os.path.exists(file):
+            db_rem_extracted(file)
+    min_age = float(orphan_config.get('min_age_hours', 72)) * 3600
+    quarantine = os.path.realpath(orphan_config['quarantine']) if orphan_config.get('quarantine') else None
+    orphans = []
+    for name in ['seeding', 'extracted']:
+        directory = config_data['directories'][name]
+        for item in sorted(os.listdir(directory)):
+            path = os.path.join(directory, item)
+            if quarantine is not None and os.path.realpath(path) == quarantine:
+                continue
+            if name == 'seeding':
+                if owned_by_torrent(path, seeding_dirs):
+                    continue
+                if any(file == path or file.startswith(path + os.sep) for file in copied):
+                    continue
+            # Extracted content is kept while the torrent it was extracted from is still seeding, content of
+            # unknown origin is only left over once everything in it has been organized.
+            elif path in extracted and extracted[path] in seeding_dirs:
+                continue
+            if holds_pending(path):
+                logging.debug('Ignoring orphan candidate with files not yet organized: {0}'.format(path))
+                continue
+            try:
+                size, newest = path_stats(path)
+            except OSError:
+                logging.exception('Unable to check orphan candidate: {0}'.format(path))
+                continue
+            if time.time() - newest < min_age:
+                logging.debug('Ignoring recently modified orphan candidate: {0}'.format(path))
+                continue
+            orphans.append((path, name, size))
+    return orphans
+
+def orphan_sweep():
+    """
+    Quarantine, delete or report content left behind by torrents removed outside of the organizer.
+    """
+    action = orphan_config.get('action', 'report')
+    if action == 'quarantine' and not orphan_config.get('quarantine'):
+        logging.error('Orphan action is quarantine but no quarantine directory is configured.')
+        return
+    try:
+        orphans = find_orphans()
+    except:
+        logging.exception('Unable to search for orphaned files.')
+        return
+
+    handled = 0
+    handled_size = 0
+    failed = 0
+    for path, name, size in orphans:
+        if action == 'report':
+            logging.info('Orphaned {0} item ({1}): {2}'.format(name, format_size(size), path))
+            handled += 1
+            handled_size += size
+            continue
+        if args.dryrun:
+            logging.info('Would {0} orphaned {1} item ({2}): {3}'.format(action, name, format_size(size), path))
+            handled += 1
+            handled_size += size
+            continue
+        try:
+            if action == 'delete':
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                db_rem_extracted(path)
+                logging.info('Deleted orphaned {0} item ({1}): {2}'.format(name, format_size(size), path))
+            elif action == 'quarantine':
+                target_dir = os.path.join(orphan_config['quarantine'], name)
+                if not os.path.exists(target_dir):
+                    os.makedirs(target_dir)
+                # Keep earlier quarantined items with the same name in a folder named after this run.
+                if os.path.exists(os.path.join(target_dir, os.path.basename(path))):
+                    target_dir = os.path.join(target_dir, str(int(time.time())))
+                    if not os.path.exists(target_dir):
+                        os.makedirs(target_dir)
+                target = io_move(path, target_dir)
+                db_rem_extracted(path)
+                logging.info('Quarantined orphaned {0} item ({1}): {2} to {3}'.format(name, format_size(size), path, target))
+            else:
+                logging.error('Unknown orphan action: {0}'.format(action))
+                return
+            handled += 1
+            handled_size += size
+        except:
+            logging.exception('Failed to {0} orphaned item: {1}'.format(action, path))
+            failed += 1
+
+    if len(orphans) > 0:
+        if action == 'report' or args.dryrun:
+            logging.info('Found {0} orphaned items, {1} could be reclaimed.'.format(handled, format_size(handled_size)))
+        elif action == 'delete':
+            logging.info('Deleted {0} orphaned items, reclaimed {1}.'.format(handled, format_size(handled_size)))
+        else:
+            logging.info('Quarantined {0} orphaned items, {1} moved to {2}.'.format(handled, format_size(handled_size), orphan_config['quarantine']))
+    if failed > 0:
+        logging.error('Failed to {0} {1} orphaned items.'.format(action, failed))
+
+# Clean up files for torrents that were possibly manually removed from transmission.
+if orphan_config is not None:
+    orphan_sweep()
 
 
 # Perform global clean up of propers and repacks by deleting the files they are replacing.
 if args.properclean:
     for file in find_files(config_data['directories']['destination'], r'.*\.(proper|repack)\..*\.(mkv|mp4|avi|ogm)$'):
         proper_cleanup(file)
+
+# Perform global clean up of lower quality duplicates.
+if args.dedup:
+    db_prune_parsed()
+    reclaimed = 0
+    for root, dirs, files in os.walk(config_data['directories']['destination']):
+        dirs.sort()
+        if any(re.match(video_file_regex, file, re.IGNORECASE) for file in files):
+            reclaimed += dedup_directory(root)
+    if args.dryrun:
+        logging.info('Duplicate cleanup could reclaim {0}.'.format(format_size(reclaimed)))
+    else:
+        logging.info('Duplicate cleanup reclaimed {0}.'.format(format_size(reclaimed)))
     
+# Summarize disk space planned against what was available on each volume.
+for device in sorted(space_paths, key=lambda x: space_paths[x]):
+    logging.info('Space on {0}: {1} planned, {2} deferred, {3} available, {4} reserved.'.format(
+        space_paths[device], format_size(space_planned.get(device, 0)), format_size(space_deferred.get(device, 0)),
+        format_size(space_available[device]), format_size(space_reserve)))
+
 logging.debug('{0} finished.'.format(scriptdesc))